@@ -1,5 +1,7 @@
 import os
 import time
+import copy
+import hashlib
 import plugins
 import sqlite3
 from datetime import datetime, timedelta
@@ -9,6 +11,8 @@ from common.log import logger
 from plugins import *
 from config import conf
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 
 
 @plugins.register(
@@ -48,7 +52,27 @@ class DarkRoom(Plugin):
         self.duration_of_ban = self.config.get("duration_of_ban")
         # 加载违禁词配置
         self.check_prohibited_words = self.config.get("check_prohibited_words")
-        self.prohibited_words = self.config.get("prohibited_words", [])
+        # 违禁词判定缓存(LRU)，键为消息内容哈希，值为命中的违禁词或 None
+        self.verdict_cache_size = self.get_verdict_cache_size()
+        self.verdict_cache = OrderedDict()
+        self.verdict_cache_lock = threading.Lock()
+        # 违禁词表版本，每次更换词表时递增
+        self.verdict_cache_version = 0
+        # 缓存命中/未命中次数
+        self.verdict_cache_hits = 0
+        self.verdict_cache_misses = 0
+        # 加载违禁词表
+        self.set_prohibited_words(self.config.get("prohibited_words", []))
+        # 影子模式统计数据的锁
+        self.shadow_lock = threading.Lock()
+        # 影子模式评估线程池，避免占用消息处理线程
+        self.shadow_executor = None
+        # 离线日志回放线程，同一时间只允许一个回放
+        self.shadow_replay_thread = None
+        # 影子模式配置版本，每次重新加载配置时递增
+        self.shadow_generation = 0
+        # 加载影子模式配置(候选违禁词试运行，不影响任何用户)
+        self.load_shadow_config()
         # 加载管理员密码
         self.admin_password = self.config.get("admin_password")
         # 初始化管理员列表
@@ -337,6 +361,17 @@ class DarkRoom(Plugin):
         logger.info("[DarkRoom] 接收到退出信号，正在关闭数据库连接...")
         self.close_db_connection_and_cursor()
 
+    def reload(self):
+        # 重新加载配置
+        self.config = super().load_config()
+        self.check_prohibited_words = self.config.get("check_prohibited_words")
+        # 重新加载违禁词表，判定缓存随之清空
+        self.verdict_cache_size = self.get_verdict_cache_size()
+        self.set_prohibited_words(self.config.get("prohibited_words", []))
+        # 重新加载影子模式配置
+        self.load_shadow_config()
+        logger.info("[DarkRoom] 配置已重新加载")
+
     def update_message_tracker(self, content, current_time, user_name, user_id):
         # 检查用户的消息跟踪器是否存在
         if user_id not in self.user_message_tracker:
@@ -363,18 +398,316 @@ class DarkRoom(Plugin):
                 self.user_message_tracker[user_id]['last_message'] = content
                 self.user_message_tracker[user_id]['first_message_time'] = current_time
 
+    def get_content_hash(self, content):
+        # 规范化消息内容并计算哈希
+        return hashlib.sha1(content.strip().encode('utf-8')).hexdigest()
+
+    def get_verdict_cache_size(self):
+        # 读取判定缓存容量，不大于0时关闭缓存
+        try:
+            return max(int(self.config.get("verdict_cache_size", 1024)), 0)
+        except (TypeError, ValueError):
+            logger.warning(f"[DarkRoom] 判定缓存容量配置无效: {self.config.get('verdict_cache_size')}，使用默认值 1024")
+            return 1024
+
+    def set_prohibited_words(self, words):
+        # 更换违禁词表，并清空判定缓存
+        with self.verdict_cache_lock:
+            self.prohibited_words = tuple(words)
+            self.verdict_cache.clear()
+            self.verdict_cache_version += 1
+        logger.debug(f"[DarkRoom] 违禁词表已加载，共 {len(self.prohibited_words)} 个，判定缓存已清空。")
+
+    def find_prohibited_word(self, content):
+        """
+        查找消息中的违禁词，重复内容直接使用缓存的判定结果。
+
+        返回命中的违禁词，未命中时返回 None。
+        """
+        # 缓存未开启，直接扫描
+        if self.verdict_cache_size <= 0:
+            return next((word for word in self.prohibited_words if word in content), None)
+        content_hash = self.get_content_hash(content)
+        with self.verdict_cache_lock:
+            if content_hash in self.verdict_cache:
+                self.verdict_cache_hits += 1
+                # 标记为最近使用
+                self.verdict_cache.move_to_end(content_hash)
+                return self.verdict_cache[content_hash]
+            self.verdict_cache_misses += 1
+            words = self.prohibited_words
+            version = self.verdict_cache_version
+        # 在锁外扫描违禁词
+        matched_word = next((word for word in words if word in content), None)
+        with self.verdict_cache_lock:
+            # 扫描期间词表未变更才写入缓存
+            if self.verdict_cache_version == version:
+                self.verdict_cache[content_hash] = matched_word
+                self.verdict_cache.move_to_end(content_hash)
+                # 超出容量，淘汰最久未使用的条目
+                while len(self.verdict_cache) > self.verdict_cache_size:
+                    self.verdict_cache.popitem(last=False)
+        return matched_word
+
+    def display_verdict_cache_stats(self, user_id):
+        # 检查是否有管理员权限
+        if not self.check_admin_list(user_id):
+            return "[DarkRoom] 你没有管理员权限，无法查看判定缓存。😹"
+        with self.verdict_cache_lock:
+            size = len(self.verdict_cache)
+            hits = self.verdict_cache_hits
+            misses = self.verdict_cache_misses
+        total = hits + misses
+        hit_rate = hits / total if total else 0
+        return f"[DarkRoom] 违禁词判定缓存: {size}/{self.verdict_cache_size}\n命中: {hits}，未命中: {misses}，命中率: {hit_rate:.2%}"
+
     def check_user_prohibited_words(self, content, user_name, user_id):
         if self.check_prohibited_words:
             # 检查用户是否触发违禁词
-            for word in self.prohibited_words:
-                if word in content:
-                    logger.info(f"[DarkRoom] 用户 {user_name} ({user_id}) 触发违禁词: {word}")
-                    return True  # 触发了违禁词
+            word = self.find_prohibited_word(content)
+            if word is not None:
+                logger.info(f"[DarkRoom] 用户 {user_name} ({user_id}) 触发违禁词: {word}")
+                return True  # 触发了违禁词
             return False  # 未触发违禁词
         else:
             # 未开启违禁词检查，不做任何事
             return False
 
+    def new_shadow_stats(self):
+        # 初始化影子模式统计数据
+        return {
+            # 已评估的消息数
+            'total': 0,
+            # 现行词表命中的消息数
+            'live_hits': 0,
+            # 候选词表命中的消息数
+            'shadow_hits': 0,
+            # 仅候选词表命中(将新增的封禁)
+            'extra_hits': 0,
+            # 仅现行词表命中(将不再封禁)
+            'missed_hits': 0,
+            # 每个违禁词的命中次数: {word: [现行, 候选]}
+            'words': {},
+            # 每个群的命中情况: {group: {'total', 'live', 'shadow'}}
+            'groups': {}
+        }
+
+    def load_shadow_config(self):
+        """加载影子模式配置，重建线程池并清空统计数据"""
+        self.shadow_mode = self.config.get("shadow_mode", False)
+        self.shadow_prohibited_words = self.config.get("shadow_prohibited_words", [])
+        self.shadow_worker_count = self.config.get("shadow_worker_count", 2)
+        # 只允许回放该目录中的离线日志
+        self.shadow_log_dir = self.config.get("shadow_log_dir", "./plugins/DarkRoom/shadow_logs")
+        # 最多允许堆积的待评估消息数，超出时丢弃样本
+        self.shadow_max_pending = self.config.get("shadow_max_pending", 1000)
+        self.shadow_pending = threading.BoundedSemaphore(max(self.shadow_max_pending, 1))
+        # 关闭旧的线程池，按新配置重新创建
+        self.close_shadow_executor()
+        self.start_shadow_executor()
+        with self.shadow_lock:
+            # 实时消息与离线日志分开统计
+            self.shadow_stats = {'live': self.new_shadow_stats(), 'replay': self.new_shadow_stats()}
+            # 因待处理任务过多而丢弃的样本数
+            self.shadow_dropped = 0
+            # 使进行中的回放中止
+            self.shadow_generation += 1
+
+    def evaluate_shadow_words(self, content, user_group_name, source="live"):
+        """使用现行词表和候选词表分别检查消息，只记录统计，不处理用户"""
+        try:
+            # 未开启违禁词检查时，现行词表不会封禁任何人
+            live_words = self.prohibited_words if self.check_prohibited_words else ()
+            # 词表中可能有重复的违禁词，去重后再统计
+            live_matched = list(dict.fromkeys(word for word in live_words if word in content))
+            shadow_matched = list(dict.fromkeys(word for word in self.shadow_prohibited_words if word in content))
+            group_name = user_group_name or "私聊"
+            with self.shadow_lock:
+                stats = self.shadow_stats[source]
+                stats['total'] += 1
+                if live_matched:
+                    stats['live_hits'] += 1
+                if shadow_matched:
+                    stats['shadow_hits'] += 1
+                if shadow_matched and not live_matched:
+                    stats['extra_hits'] += 1
+                if live_matched and not shadow_matched:
+                    stats['missed_hits'] += 1
+                # 按违禁词统计
+                for word in live_matched:
+                    stats['words'].setdefault(word, [0, 0])[0] += 1
+                for word in shadow_matched:
+                    stats['words'].setdefault(word, [0, 0])[1] += 1
+                # 按群统计
+                group = stats['groups'].setdefault(group_name, {'total': 0, 'live': 0, 'shadow': 0})
+                group['total'] += 1
+                if live_matched:
+                    group['live'] += 1
+                if shadow_matched:
+                    group['shadow'] += 1
+        except Exception as e:
+            logger.error(f"[DarkRoom] 影子模式评估失败: {e}")
+
+    def submit_shadow_evaluation(self, content, user_group_name):
+        # 只读取一次，避免重新加载配置时被并发替换
+        executor = self.shadow_executor
+        pending = self.shadow_pending
+        # 影子模式未开启，不做任何事
+        if not self.shadow_mode or executor is None:
+            return
+        try:
+            # 待处理任务过多时丢弃本条样本，避免任务无限堆积
+            if not pending.acquire(blocking=False):
+                with self.shadow_lock:
+                    self.shadow_dropped += 1
+                return
+            try:
+                # 提交到线程池，不阻塞消息处理
+                future = executor.submit(self.evaluate_shadow_words, content, user_group_name)
+            except Exception:
+                pending.release()
+                raise
+            future.add_done_callback(lambda _: pending.release())
+        except Exception as e:
+            # 影子模式出错不能影响正常处理
+            logger.warning(f"[DarkRoom] 影子模式提交评估失败: {e}")
+
+    def start_shadow_executor(self):
+        # 配置了候选违禁词才创建影子模式线程池
+        if self.shadow_prohibited_words and self.shadow_executor is None:
+            self.shadow_executor = ThreadPoolExecutor(max_workers=self.shadow_worker_count, thread_name_prefix="DarkRoomShadow")
+
+    def close_shadow_executor(self):
+        # 关闭影子模式线程池，已提交的任务仍会执行完毕
+        if getattr(self, 'shadow_executor', None) is not None:
+            self.shadow_executor.shutdown(wait=False)
+            self.shadow_executor = None
+            logger.debug("[DarkRoom] 影子模式线程池已关闭")
+
+    def replay_shadow_log(self, log_path):
+        """
+        使用离线消息日志评估候选词表。
+
+        日志每行一条消息，格式为 `群名<TAB>消息内容` 或仅 `消息内容`。
+        回放结果与实时消息分开统计，每次回放前清空上一次的回放结果。
+        """
+        count = 0
+        with self.shadow_lock:
+            self.shadow_stats['replay'] = self.new_shadow_stats()
+            generation = self.shadow_generation
+        try:
+            with open(log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    # 回放期间重新加载了配置，结果已失效
+                    if self.shadow_generation != generation:
+                        logger.warning(f"[DarkRoom] 配置已重新加载，离线日志 {log_path} 回放中止。")
+                        return
+                    line = line.rstrip('\n')
+                    if not line.strip():
+                        continue
+                    if '\t' in line:
+                        user_group_name, content = line.split('\t', 1)
+                    else:
+                        user_group_name, content = "", line
+                    # 未填写群名的消息统一归入离线日志
+                    self.evaluate_shadow_words(content.strip(), user_group_name.strip() or "离线日志", "replay")
+                    count += 1
+            logger.info(f"[DarkRoom] 离线日志 {log_path} 回放完成，共评估 {count} 条消息。")
+        except Exception as e:
+            logger.error(f"[DarkRoom] 离线日志 {log_path} 回放失败: {e}")
+
+    def format_shadow_stats(self, title, stats, top_n):
+        total = stats['total']
+        live_hits = stats['live_hits']
+        shadow_hits = stats['shadow_hits']
+        ret_str = f"【{title}】共 {total} 条消息"
+        ret_str += f"\n现行词表命中: {live_hits} ({live_hits / total:.2%})"
+        ret_str += f"\n候选词表命中: {shadow_hits} ({shadow_hits / total:.2%})"
+        ret_str += f"\n新增封禁: {stats['extra_hits']}，减少封禁: {stats['missed_hits']}"
+
+        # 按命中差异排序的违禁词
+        changed_words = [(word, hits) for word, hits in stats['words'].items() if hits[0] != hits[1]]
+        changed_words.sort(key=lambda item: abs(item[1][1] - item[1][0]), reverse=True)
+        if changed_words:
+            ret_str += "\n违禁词命中差异:"
+            for word, (live, shadow) in changed_words[:top_n]:
+                ret_str += f"\n[{word}] 现行: {live / total:.2%} → 候选: {shadow / total:.2%} ({shadow - live:+d})"
+
+        # 按命中差异排序的群
+        changed_groups = [(name, group) for name, group in stats['groups'].items() if group['live'] != group['shadow']]
+        changed_groups.sort(key=lambda item: abs(item[1]['shadow'] - item[1]['live']), reverse=True)
+        if changed_groups:
+            ret_str += "\n群命中差异:"
+            for name, group in changed_groups[:top_n]:
+                ret_str += f"\n[{name}] 现行: {group['live'] / group['total']:.2%} → 候选: {group['shadow'] / group['total']:.2%} ({group['shadow'] - group['live']:+d}/{group['total']})"
+        return ret_str
+
+    def display_shadow_report(self, top_n=10):
+        # 复制统计数据，避免持锁格式化
+        with self.shadow_lock:
+            stats = copy.deepcopy(self.shadow_stats)
+            dropped = self.shadow_dropped
+
+        sections = []
+        for source, title in (("live", "实时消息"), ("replay", "离线日志")):
+            if stats[source]['total'] > 0:
+                sections.append(self.format_shadow_stats(title, stats[source], top_n))
+        if not sections:
+            return "[DarkRoom] 影子模式暂无评估数据。"
+
+        ret_str = "[DarkRoom] 🐱影子模式报告:\n\n" + "\n\n".join(sections)
+        if not self.check_prohibited_words:
+            ret_str += "\n\n当前未开启违禁词检查，现行词表不会封禁任何人，已按零命中统计。"
+        if dropped:
+            ret_str += f"\n\n评估繁忙，已丢弃 {dropped} 条实时消息样本。"
+        return ret_str
+
+    def resolve_shadow_log_path(self, log_name):
+        # 解析离线日志路径，不在日志目录中时返回 None
+        if not log_name:
+            return None
+        log_dir = os.path.realpath(self.shadow_log_dir)
+        log_path = os.path.realpath(os.path.join(log_dir, log_name))
+        if os.path.commonpath([log_dir, log_path]) != log_dir or log_path == log_dir:
+            return None
+        return log_path
+
+    def handle_shadow_instruct(self, instruct_content, user_id):
+        # 检查是否有管理员权限
+        if not self.check_admin_list(user_id):
+            return "[DarkRoom] 你没有管理员权限，无法使用影子模式。😹"
+        if self.shadow_executor is None:
+            return "[DarkRoom] 未配置候选违禁词(shadow_prohibited_words)，影子模式不可用。"
+        # 解析子命令
+        parts = instruct_content.strip().split(' ', 1)
+        sub_type = parts[0]
+        sub_content = parts[1].strip() if len(parts) > 1 else ''
+        if sub_type == "":
+            # 查看影子模式报告
+            return self.display_shadow_report()
+        elif sub_type == "reset":
+            # 清空统计数据
+            with self.shadow_lock:
+                self.shadow_stats = {'live': self.new_shadow_stats(), 'replay': self.new_shadow_stats()}
+                self.shadow_dropped = 0
+            return "[DarkRoom] 影子模式统计已清空。"
+        elif sub_type == "replay":
+            # 回放离线消息日志
+            log_path = self.resolve_shadow_log_path(sub_content)
+            if log_path is None:
+                return f"[DarkRoom] 只能回放 {self.shadow_log_dir} 目录中的离线日志。😹"
+            if not os.path.isfile(log_path):
+                return f"[DarkRoom] 找不到离线日志 {sub_content}。😹"
+            with self.shadow_lock:
+                if self.shadow_replay_thread is not None and self.shadow_replay_thread.is_alive():
+                    return "[DarkRoom] 已有离线日志正在回放，请稍后再试。"
+                # 回放使用独立线程，不占用实时消息的评估线程池
+                self.shadow_replay_thread = threading.Thread(target=self.replay_shadow_log, args=(log_path,), name="DarkRoomShadowReplay", daemon=True)
+                self.shadow_replay_thread.start()
+            return f"[DarkRoom] 已开始回放离线日志 {sub_content}，稍后使用 /shadow 查看报告。"
+        else:
+            return "[DarkRoom] 未知的影子模式指令，可用: /shadow, /shadow reset, /shadow replay 文件名"
+
     def check_user_has_violated(self, content, user_name, user_group_name, user_id, e_context):
         # 直接获取当前时间戳并加上10分钟，转换为整数
         new_timestamp = int((datetime.fromtimestamp(time.time()) + timedelta(minutes=self.duration_of_ban)).timestamp())
@@ -456,6 +789,12 @@ class DarkRoom(Plugin):
             elif instruct_type == "releaseall":
                 # 释放所有小黑屋成员
                 return self.release_dark_room(user_id)
+            elif instruct_type == "cache":
+                # 查看违禁词判定缓存
+                return self.display_verdict_cache_stats(user_id)
+            elif instruct_type == "shadow":
+                # 影子模式(候选违禁词试运行)
+                return self.handle_shadow_instruct(instruct_content, user_id)
             else:
                 return None
         except Exception as e:
@@ -676,6 +1015,8 @@ class DarkRoom(Plugin):
                     if self.check_admin_list(user_id) is False:
                         # 检查用户是否有违规行为
                         self.check_user_has_violated(content, user_name, user_group_name, user_id, e_context)
+                        # 影子模式评估候选违禁词(在线程池中进行，不影响用户)
+                        self.submit_shadow_evaluation(content, user_group_name)
                     return
         except Exception as e:
             logger.error(f"[DarkRoom] 处理上下文事件时出错: {e}")